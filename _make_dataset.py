@@ -4,8 +4,9 @@ import torchvision
 import cv2
 import albumentations as A
 import numpy as np
-import skimage.measure
+import scipy.ndimage as ndi
 import pathlib
+import os
 import re
 import argparse
 import warnings
@@ -14,50 +15,62 @@ from typing import ClassVar, Callable, Iterable, Union, Dict, List
 import time
 from collections import OrderedDict, defaultdict, namedtuple
 import contextlib
+import concurrent.futures
+import functools
 import itertools
 from tqdm.auto import tqdm
+try: # optional: label connected components of masks on CUDA devices
+    import cupy
+    import cupyx.scipy.ndimage
+except ImportError:
+    cupy = None
 
 import utils
 
 IMAGE_SUFFIXES = ['.png', '.jpeg', '.jpg', '.bmp', ] # acceptable suffixes of image files
 
-_patterns = [
-  re.compile(r'(.+)_(\d{4})(\..+)'),
-  re.compile(r'(.+)(\..+)')
-]
+_rng = np.random.default_rng() # shared by synthesize() & DatabaseRandomIterator unless another generator is given
 
-def parse_fname(fname):
+_pattern = re.compile(r'(?P<stem>.+?)(?:_(?P<time>\d{4}))?(?P<extension>\.[^.]+)')
+
+ParsedFname = namedtuple('ParsedFname', ['stem', 'time', 'extension']) # time is None if not given
+
+@functools.lru_cache(maxsize=4096)
+def _parse_fname_cached(fname):
+    m = _pattern.fullmatch(fname)
+    if not m:
+        raise Exception(f'An invalid file name "{fname}" was given')
+    return ParsedFname(*m.groups())
+
+def parse_fname(fname) -> ParsedFname:
     fname = pathlib.Path(fname).name
-    for i, pattern in enumerate(_patterns):
-        m = pattern.match(fname)
-        if m:
-            break
-        if i == len(_patterns) - 1:
-            raise Exception(f'An invalid file name "{fname}" was given')
-
-    ret = {k: None for k in ['stem', 'time', 'extension']}
-    
-    if i == 0:
-      keys = ['stem', 'time', 'extension']
-    elif i == 1:
-      keys = ['stem', 'extension']
-    else:
-        assert False
-
-    ret.update({k: v for k, v in zip(keys, m.groups())})
-    return ret    
+    return _parse_fname_cached(fname) # immutable, so the cached result can be shared
   
+def masks_to_bboxes(masks):
+    """masks: tensor of shape N x H x W
+    returns tensor of shape N x 4, i.e. (left, top, right, bottom) of each mask, the same as torchvision.ops.masks_to_boxes
+    (an empty mask gets a zero box, which YoloLabel.add drops because its area is 0)
+    """
+    height, width = masks.size(-2), masks.size(-1)
+    rows = masks.any(dim=-1)
+    cols = masks.any(dim=-2)
+    valid = rows.any(dim=-1)
+    rows, cols = rows.float(), cols.float()
+    top = rows.argmax(dim=-1)
+    bottom = height - 1 - rows.flip(-1).argmax(dim=-1)
+    left = cols.argmax(dim=-1)
+    right = width - 1 - cols.flip(-1).argmax(dim=-1)
+    bboxes = torch.stack([left, top, right, bottom], dim=-1)
+    return bboxes * valid.unsqueeze(-1)
+
 def get_bbox(masks):
     return_list = True
     if masks.ndim <= 2:
         return_list = False
         masks = torch.unsqueeze(masks, 0)
 
-    boxes = torchvision.ops.masks_to_boxes(masks).to(int)
-    ret = []
-    for box in boxes:
-        left, top, right, bottom = box
-        ret.append(dict(left=left.item(), right=right.item(), top=top.item(), bottom=bottom.item()))
+    boxes = masks_to_bboxes(masks).cpu().tolist() # transfer the result to the host at once
+    ret = [dict(left=left, right=right, top=top, bottom=bottom) for left, top, right, bottom in boxes]
     return ret if return_list else ret[0]
 
 def bbox_to_pascal_voc(bbox: dict):
@@ -102,6 +115,19 @@ def bbox_to_yolo(bbox: dict, *, image_width: int, image_height: int):
 
     return x_center, y_center, width, height
 
+def bboxes_to_yolo(bboxes: torch.Tensor, *, image_width: int, image_height: int):
+    """vectorized version of bbox_to_yolo
+    bboxes: tensor of shape N x 4, i.e. (x_min, y_min, x_max, y_max) of each box
+    returns tensor of shape N x 4, i.e. normalized (x_center, y_center, width, height) of each box
+    """
+    x_min, y_min, x_max, y_max = bboxes.to(torch.float64).unbind(dim=-1)
+    return torch.stack([
+        0.5 * (x_min + x_max) / image_width, 
+        0.5 * (y_min + y_max) / image_height, 
+        (x_max - x_min) / image_width, 
+        (y_max - y_min) / image_height
+    ], dim=-1)
+
 def yolo_to_pascal_voc(bbox: dict, *, image_width: int, image_height: int):
     x_center, y_center, width, height = bbox['x_center'], bbox['y_center'], bbox['width'], bbox['height']
     left = x_center - 0.5 * width
@@ -117,50 +143,97 @@ def yolo_to_pascal_voc(bbox: dict, *, image_width: int, image_height: int):
 def make_classwise_mask(p_mask, n_class):
     """p_mask: path to .npy file which contains class-wise masks in the VOC format
     """
-    labels = np.load(p_mask)
-    labels = torch.as_tensor(labels)
-    masks = []
-    for i_class in range(n_class):
-        classwise_mask = (labels == i_class + 1)
-        masks.append(classwise_mask)
-    return torch.stack(masks)
+    labels = torch.from_numpy(np.load(p_mask)) # zero-copy
+    class_ids = torch.arange(1, n_class + 1, dtype=labels.dtype).view(-1, 1, 1)
+    return labels.unsqueeze(0) == class_ids
+
+# 8-connectivity, which is the default of skimage.measure.label for 2D images
+_CONNECTIVITY = np.ones((3, 3), dtype=bool)
 
-def make_objectwise_mask(classwise_masks, n_class):
+def label_connected_components(classwise_mask):
+    """classwise_mask: tensor of shape H x W
+
+    returns the label map (background = 0) on the same device as classwise_mask and the number of objects.
+    A mask on a CUDA device is labeled on the GPU if CuPy is available, avoiding the round trip to the host.
+    """
+    if classwise_mask.is_cuda and cupy is not None:
+        mask = cupy.asarray(classwise_mask.to(torch.uint8)) # zero-copy via __cuda_array_interface__
+        labels, n_obj = cupyx.scipy.ndimage.label(mask, structure=cupy.asarray(_CONNECTIVITY))
+        return torch.utils.dlpack.from_dlpack(labels.toDlpack()), int(n_obj) # torch.from_dlpack needs PyTorch>=1.10
+    labels, n_obj = ndi.label(classwise_mask.cpu().numpy(), structure=_CONNECTIVITY)
+    return torch.from_numpy(labels).to(classwise_mask.device), n_obj
+
+def label_objects(classwise_mask):
+    """classwise_mask: tensor of shape H x W
+
+    returns the label map of the connected components (background = 0) and a list
+    of their extents, i.e. (row slice, column slice) for the object labeled i + 1 at index i.
+    """
+    labels, _ = label_connected_components(classwise_mask.cpu())
+    labels = labels.numpy()
+    return labels, ndi.find_objects(labels)
+
+def slices_to_bboxes(slices):
+    """list of (row slice, column slice) to tensor of shape N x 4, i.e. (left, top, right, bottom) 
+    in the same format as masks_to_bboxes, where right & bottom are inclusive
+    """
+    bboxes = [(cols.start, rows.start, cols.stop - 1, rows.stop - 1) for rows, cols in slices]
+    return torch.tensor(bboxes, dtype=torch.int64).view(-1, 4)
+
+def make_objectwise_mask(classwise_masks, n_class, return_bboxes=False):
     """classwise_masks: tensor of shape n_class x H x W (stack of masks)
+
+    If return_bboxes is True, the bounding boxes of the objects (output of masks_to_bboxes for each class)
+    are returned as well. They are obtained as a by-product of labeling.
     """
     ret = OrderedDict()
+    bboxes = OrderedDict()
     for i_class in range(n_class):
-        objectwise_masks = skimage.measure.label(classwise_masks[i_class].cpu()) # labels connected components
-        object_id = np.unique(objectwise_masks)[1:] # ignore background = 0
-        objectwise_masks = (objectwise_masks == object_id.reshape(-1, 1, 1))
+        labels, slices = label_objects(classwise_masks[i_class]) # labels connected components
+        objectwise_masks = np.zeros((len(slices),) + labels.shape, dtype=bool)
+        for i_obj, s in enumerate(slices): # only look inside the extent of each object
+            objectwise_masks[i_obj][s] = (labels[s] == i_obj + 1)
         ret.update({i_class: torch.as_tensor(objectwise_masks)})
+        bboxes.update({i_class: slices_to_bboxes(slices)})
+    if return_bboxes:
+        return ret, bboxes
     return ret
     
 
 @dataclasses.dataclass
 class Video:
+    backend: ClassVar[str] = 'opencv' if utils.av is None else 'pyav' # library used to decode videos
+
     p_video: pathlib.Path
 
     stem: str = dataclasses.field(init=False)
-    capture: cv2.VideoCapture = dataclasses.field(init=False, default=None)
+    capture: Union[cv2.VideoCapture, utils.AVCapture] = dataclasses.field(init=False, default=None)
     is_open: bool = dataclasses.field(init=False, default=False)
 
     def __post_init__(self):
         parsed = parse_fname(self.p_video)
-        self.stem = parsed['stem']
+        self.stem = parsed.stem
 
     def make_capture(self) -> None:
         if self.is_open:
             return 
-        self.capture = cv2.VideoCapture(str(self.p_video))
-        if not self.capture.isOpened():
-            raise Exception(f'Cannot open file {p_video}')
+        if self.backend == 'pyav':
+            self.capture = utils.open_video_av(self.p_video)
+            if self.capture is None: # frames cannot be indexed with PyAV
+                self.backend = 'opencv'
+        if self.backend != 'pyav':
+            self.capture = cv2.VideoCapture(str(self.p_video))
+            if not self.capture.isOpened():
+                raise Exception(f'Cannot open file {self.p_video}')
         self.is_open = True
 
     def close(self) -> None:
-        self.capture.release()
+        if self.backend == 'pyav':
+            self.capture.close()
+        else:
+            self.capture.release()
+            assert not self.capture.isOpened()
         self.is_open = False
-        assert not self.capture.isOpened()
 
     @contextlib.contextmanager
     def open(self):
@@ -172,7 +245,8 @@ class Video:
 
     def read_frame(self, i_frame, device=None, as_numpy=False):
         try:
-            frame = utils.read_frame(self.capture, i_frame, device=device, as_numpy=as_numpy)
+            read_frame = utils.read_frame_av if self.backend == 'pyav' else utils.read_frame
+            frame = read_frame(self.capture, i_frame, device=device, as_numpy=as_numpy)
         except utils.FrameCannotBeLoaded:
             suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(i_frame % 10, 'th')
             raise utils.FrameCannotBeLoaded(f'Cannot load {i_frame}{suffix} frame from a video {self.p_video}')
@@ -181,6 +255,8 @@ class Video:
     def __len__(self):
         if not self.is_open:
             raise ValueError('cannot get the number of frames from closed video')
+        if self.backend == 'pyav':
+            return utils.count_frames_av(self.capture)
         n_frame = self.capture.get(cv2.CAP_PROP_FRAME_COUNT)
         return int(n_frame)
 
@@ -236,7 +312,7 @@ class FieldVideo(Video):
                 image = RepImage(p_image=p_rep_image, p_mask=p_mask, video=self, classes=self.classes, device=device, stem=self.stem, label_editor=label_editor)
                 self.rep_images.append(image)
         self.classes = image.classes # reflect the effect of label_editor
-        self.orig_images = [rep_image.orig_image for rep_image in self.rep_images] # make copy for rep_image_as()
+        self.orig_images = [rep_image.orig_image for rep_image in self.rep_images] # keep references for rep_image_as()
 
     @contextlib.contextmanager
     def rep_images_as(self, tmp_images):
@@ -281,18 +357,19 @@ class RepImage:
     classwise_mask: torch.Tensor = dataclasses.field(init=False)
     objectwise_mask: dict = dataclasses.field(init=False)
     objects: dict = dataclasses.field(init=False)
+    bboxes: dict = dataclasses.field(init=False)
 
     def __post_init__(self, label_editor):
         self.device = torch.device(self.device)
         parsed = parse_fname(self.p_image)
-        self.timestamp = time.strptime(parsed['time'], '%M%S')
+        self.timestamp = time.strptime(parsed.time, '%M%S')
         self.image = utils.read_image(self.p_image, device=self.device)
         self.height = self.image.size(-2)
         self.width = self.image.size(-1)
         # read mask
         n_class = len(self.classes)
         classwise_mask = make_classwise_mask(self.p_mask, n_class)
-        objectwise_mask = make_objectwise_mask(classwise_mask, n_class)
+        objectwise_mask, bboxes = make_objectwise_mask(classwise_mask, n_class, return_bboxes=True)
 
         ### edit masks
         if label_editor is not None:
@@ -301,33 +378,49 @@ class RepImage:
                 classwise_mask=classwise_mask, 
                 objectwise_mask=objectwise_mask
             )
+            # the objects may have been changed by the editor
+            bboxes = {i_class: masks_to_bboxes(masks) for i_class, masks in objectwise_mask.items()}
+
+        # bounding boxes of the objects of each class, stored as a tensor of shape n_obj x 4 (left, top, right, bottom)
+        self.bboxes = {i_class: bboxes[i_class].to(torch.int16) for i_class in objectwise_mask}
 
         # send masks to device
-        classwise_mask = classwise_mask.to(self.device)
-        for i_class, masks in objectwise_mask.items():
-            objectwise_mask.update({i_class: masks.to(self.device)})
+        if self.device.type == 'cuda': 
+            # a single asynchronous copy from pinned memory instead of one blocking copy per class
+            sizes = [len(classwise_mask)] + [len(masks) for masks in objectwise_mask.values()]
+            staged = torch.empty((sum(sizes), self.height, self.width), dtype=torch.bool, pin_memory=True)
+            torch.cat([classwise_mask.to(torch.bool)] + [masks.to(torch.bool) for masks in objectwise_mask.values()], out=staged)
+            masks_on_device = staged.to(self.device, non_blocking=True)
+            classwise_mask, *masks_list = torch.split(masks_on_device, sizes)
+            objectwise_mask = OrderedDict(zip(objectwise_mask.keys(), masks_list))
+        else:
+            classwise_mask = classwise_mask.to(self.device)
+            for i_class, masks in objectwise_mask.items():
+                objectwise_mask.update({i_class: masks.to(self.device)})
 
         # construct foreground objects
         self.objects = {}
         for i_class, class_name in enumerate(self.classes):
             obj_list = []
             masks = objectwise_mask[i_class] # obj-wise masks of objects of i-th class
-            for mask in masks:
+            for idx, mask in enumerate(masks):
                 obj = ForegroundObject(
                     rep_image=self,
                     mask=mask,
                     i_class=i_class,
-                    class_name=class_name
+                    class_name=class_name,
+                    idx=idx
                 )        
                 obj_list.append(obj)
             self.objects.update({i_class: obj_list})
 
         self.classwise_mask = classwise_mask
         self.objectwise_mask = objectwise_mask
-        self.orig_image = self.image.detach().clone() # make copy
+        self.orig_image = self.image # no copy needed: set_image() replaces self.image instead of modifying it in-place
 
     def to(self, device, *, mask=False) -> None:
         self.image = self.image.to(device)
+        self.orig_image = self.orig_image.to(device)
         self.device = self.image.device
         if mask:
             self.classwise_mask = self.classwise_mask.to(device)
@@ -335,13 +428,13 @@ class RepImage:
                 self.objectwise_mask.update({i_class: masks.to(device)})
 
     def set_image(self, new_image: torch.Tensor) -> None:
-        """set a new image as the object's image attribute and make a new cropped image.
+        """set a new image as the object's image attribute, from which the objects crop their images.
         new_image must be consistent with the old one in spatial information, i.e. you will
         get a nonsense result if you pass an image which went through data augmentation 
         where spatial information is not preserved.
         """
         assert new_image.size() == self.image.size(), 'cannot set a tensor of incompatible size'
-        self.image[:] = new_image # substitute in-place
+        self.image = new_image.to(device=self.device, dtype=self.image.dtype) # no copy if already on the device
 
     @contextlib.contextmanager
     def image_as(self, tmp_image):
@@ -379,35 +472,32 @@ class RepImage:
 
 @dataclasses.dataclass
 class ForegroundObject:
-    # ToDo: rename __random_rotate to __random_flip_and_rotate
-    __random_rotate: ClassVar[Callable] = torchvision.transforms.Compose([
-        torchvision.transforms.RandomHorizontalFlip(),
-        torchvision.transforms.RandomRotation(degrees=180, expand=True, fill=0)
-    ])
-    # __random_rotate: ClassVar[Callable] = torchvision.transforms.RandomRotation(degrees=180, expand=True, fill=0)
     __bbox_formats: ClassVar[List[str]] = ['pascal_voc', 'albumentations', 'coco', 'yolo']
 
     rep_image: RepImage
     mask: torch.Tensor
     i_class: int
     class_name: str
+    idx: int # index of this object among the objects of the same class in rep_image
 
-    bbox: dict = dataclasses.field(init=False)
-    image_cropped: torch.Tensor = dataclasses.field(init=False)
     mask_cropped: torch.Tensor = dataclasses.field(init=False)
 
     def __post_init__(self):
-        self.bbox = get_bbox(self.mask)
-        top, bottom, left, right = self.bbox['top'], self.bbox['bottom'], self.bbox['left'], self.bbox['right']
-        self.image_cropped = self.crop(self.rep_image.image) # self.image[:, top:bottom, left:right]
         self.mask_cropped = self.crop(self.mask) # self.mask[top:bottom, left:right]
 
+    @property
+    def bbox(self) -> dict:
+        left, top, right, bottom = self.rep_image.bboxes[self.i_class][self.idx].tolist()
+        return dict(left=left, right=right, top=top, bottom=bottom)
+
+    @property
+    def image_cropped(self) -> torch.Tensor:
+        # cropped on every access so that a temporary image set by RepImage.set_image() is reflected
+        return self.crop(self.rep_image.image) # self.rep_image.image[:, top:bottom, left:right]
+
     def crop(self, tensor):
-        top, bottom, left, right = self.bbox['top'], self.bbox['bottom'], self.bbox['left'], self.bbox['right']
-        tensor = tensor.transpose(0, -2).transpose(1, -1)
-        tensor = tensor[top:bottom, left:right]
-        tensor = tensor.transpose(1, -1).transpose(0, -2)
-        return tensor
+        bbox = self.bbox # a property, so read it only once
+        return tensor[..., bbox['top']:bbox['bottom'], bbox['left']:bbox['right']]
 
     def bbox_to(self, format):
         if format not in self.__bbox_formats:
@@ -435,27 +525,29 @@ class ForegroundObject:
         background: array or tensor
           An image on which the object is placed
         """
+        image_cropped = self.image_cropped # a property, so read it only once
         image_and_mask_cropped = torch.cat(
-            [self.image_cropped, torch.unsqueeze(self.mask_cropped, 0)]
+            [image_cropped, torch.unsqueeze(self.mask_cropped, 0)]
         )
         if scale_jitter:
-            _, crop_height, crop_width = self.image_cropped.size()
+            _, crop_height, crop_width = image_cropped.size()
             scale = np.random.uniform(0.1, 2.0) # Ghiasi, G., Cui, Y., Srinivas, A., Qian, R., Lin, T.-Y., Cubuk, E. D., Le, Q. V., & Zoph, B. (2021). Simple Copy-Paste is a Strong Data Augmentation Method for Instance Segmentation. In 2021 IEEE/CVF Conference on Computer Vision and Pattern Recognition (CVPR). https://doi.org/10.1109/cvpr46437.2021.00294
             resized_height, resized_width = int(crop_height * scale), int(crop_width * scale)
-            resized = torchvision.transforms.functional.resize(
+            image_and_mask_cropped = torchvision.transforms.functional.resize(
                 image_and_mask_cropped, 
                 size=(resized_height, resized_width)
             )
-            rotated = self.__random_rotate(resized)
-        else:
-            rotated = self.__random_rotate(image_and_mask_cropped)
-        image_cropped, mask_cropped = torch.split(rotated, [3, 1], dim=0)
-        mask_cropped = torch.squeeze(mask_cropped, dim=0).to(torch.bool)
-        _, h, w = image_cropped.size() # size of cropped region after rotation
+        # random horizontal flip & random rotation (expand=True), sampled in the same way as 
+        # torchvision.transforms.RandomHorizontalFlip() & RandomRotation(degrees=180)
+        flip = bool(torch.rand(1) < 0.5)
+        angle = float(torch.empty(1).uniform_(-180.0, 180.0).item())
+        _, crop_height, crop_width = image_and_mask_cropped.size()
+        h, w = utils.rotated_size(angle, width=crop_width, height=crop_height) # size of cropped region after rotation
+        theta = utils.make_rotation_theta([angle], width=crop_width, height=crop_height, device=image_and_mask_cropped.device)
         
         top = np.random.randint(0, self.rep_image.height - h)
         left = np.random.randint(0, self.rep_image.width - w)
-        background[:, top:top+h, left:left+w][:, mask_cropped] = image_cropped[:, mask_cropped]
+        mask_cropped = _rotate_and_paste(image_and_mask_cropped, background, theta, flip=flip, top=top, left=left, height=h, width=w)
         
         # bounding box info
         bbox = get_bbox(mask_cropped)
@@ -475,6 +567,28 @@ class ForegroundObject:
             return mask_info
 
 
+def _rotate_and_paste(image_and_mask_cropped, background, theta, *, flip: bool, top: int, left: int, height: int, width: int):
+    """flip & rotate a cropped object (and its mask) and paste it on the background in-place.
+    Returns the rotated mask.
+
+    image_and_mask_cropped: Tensor (4, H, W)
+    theta: output of utils.make_rotation_theta() for a single angle
+    height, width: size after rotation given by utils.rotated_size()
+    """
+    if flip:
+        image_and_mask_cropped = image_and_mask_cropped.flip(-1)
+    grid = utils.affine_grid(theta, out_width=width, out_height=height)
+    rotated = torch.nn.functional.grid_sample(
+        image_and_mask_cropped.unsqueeze(0).float(), grid, mode='nearest', padding_mode='zeros', align_corners=False
+    )
+    rotated = rotated.squeeze(0).round().to(image_and_mask_cropped.dtype)
+    image_cropped, mask_cropped = torch.split(rotated, [3, 1], dim=0)
+    mask_cropped = torch.squeeze(mask_cropped, dim=0).to(torch.bool)
+    dst = background[:, top:top+height, left:left+width]
+    dst.copy_(torch.where(mask_cropped.unsqueeze(0), image_cropped, dst))
+    return mask_cropped
+
+
 class ObjectDatabase:
     def __init__(self, classes: List[str]):
         self.classes = classes
@@ -542,8 +656,8 @@ class ObjectDatabase:
             for rep_image, orig_image in zip(self.rep_images, self.orig_images):
                 rep_image.set_image(orig_image)
 
-    def random_iter(self, *, total, p, min_n_obj):
-        return DatabaseRandomIterator(self, total=total, p=p, min_n_obj=min_n_obj)
+    def random_iter(self, *, total, p, min_n_obj, rng=None):
+        return DatabaseRandomIterator(self, total=total, p=p, min_n_obj=min_n_obj, rng=rng)
 
 
 class DatabaseStats:
@@ -575,7 +689,7 @@ class DatabaseStats:
 
 
 class DatabaseRandomIterator:
-    def __init__(self, database: ObjectDatabase, *, total: int, p: List[float]=None, min_n_obj=3):
+    def __init__(self, database: ObjectDatabase, *, total: int, p: List[float]=None, min_n_obj=3, rng: np.random.Generator=None):
         self.database = database
         self.n_class = database.n_class
         self.min_n_obj = min_n_obj
@@ -587,7 +701,7 @@ class DatabaseRandomIterator:
         else:
             self.get_candidate_objects = self._get_candidate_objects_class_aware # randomly sample a class first, then randomly sample an object from that class
             self.p = p # class probabilities
-        self.rng = np.random.default_rng()
+        self.rng = _rng if rng is None else rng
 
     def __iter__(self):
         return self
@@ -596,7 +710,7 @@ class DatabaseRandomIterator:
         if self.counter >= self.total:
             raise StopIteration
         objects = self.get_candidate_objects()
-        obj = self.rng.choice(objects)
+        obj = objects[self.rng.integers(len(objects))] # much faster than rng.choice() on a list
         self.counter += 1
         return obj
 
@@ -604,7 +718,7 @@ class DatabaseRandomIterator:
         return self.database.get()
 
     def _get_candidate_objects_class_aware(self):
-        i_class = self.rng.choice(range(self.n_class), p=self.p)
+        i_class = self.rng.choice(self.n_class, p=self.p)
         return self.database.get(i_class)
 
     def validate_database(self):
@@ -642,6 +756,8 @@ class BaseLabel:
             assert image_width is None and image_height is None
 
 
+YoloBBox = namedtuple('YoloBBox', ['i_class', 'x_center', 'y_center', 'width', 'height'])
+
 class YoloLabel(BaseLabel):
     """YOLO format bounding box annotation.
     """
@@ -667,6 +783,7 @@ class YoloLabel(BaseLabel):
             assert i_class is None and bbox is None
             x_center, y_center, width, height = obj.bbox_to_yolo()    
             i_class = obj.i_class
+            bbox = obj.bbox
         else:
             assert i_class is not None and bbox is not None
             x_center, y_center, width, height = bbox_to_yolo(bbox, image_width=self.image_width, image_height=self.image_height)
@@ -676,17 +793,22 @@ class YoloLabel(BaseLabel):
             warnings.warn(f'ignore a bounding box whose area is {area} <= min_area')
             return
 
-        self.bboxes.append(
-            OrderedDict(
-                i_class=i_class, 
-                x_center=x_center,
-                y_center=y_center,
-                width=width,
-                height=height
-            )
-        )
+        self.bboxes.append(YoloBBox(i_class, x_center, y_center, width, height))
         self.bboxes_voc.append(bbox)
 
+    def extend(self, *, i_class: int, bboxes: torch.Tensor):
+        """add the bounding boxes of the objects of the same class at once.
+        bboxes: tensor of shape N x 4, i.e. (left, top, right, bottom) of each box
+        """
+        yolo = bboxes_to_yolo(bboxes, image_width=self.image_width, image_height=self.image_height)
+        area = yolo[:, 2] * yolo[:, 3]
+        keep = area > self.min_area
+        if not keep.all():
+            warnings.warn(f'ignore {(~keep).sum().item()} bounding box(es) whose area is <= min_area')
+        for (x_center, y_center, width, height), (left, top, right, bottom) in zip(yolo[keep].tolist(), bboxes[keep].tolist()):
+            self.bboxes.append(YoloBBox(i_class, x_center, y_center, width, height))
+            self.bboxes_voc.append(dict(left=left, right=right, top=top, bottom=bottom))
+
     @staticmethod
     def parse_line(line):
         vals = line.split()
@@ -706,7 +828,7 @@ class YoloLabel(BaseLabel):
         height = float(height)
         # conf = float(conf)
         # genertic situation is not fully considered yet
-        return OrderedDict(i_class=i_class, x_center=x_center, y_center=y_center, width=width, height=height)
+        return YoloBBox(i_class, x_center, y_center, width, height)
 
     @classmethod
     def load(cls, fname, *, image=None, image_width=None, image_height=None):
@@ -719,23 +841,20 @@ class YoloLabel(BaseLabel):
             for line in f:
                 bbox = cls.parse_line(line)
                 label.bboxes.append(bbox)
-                bbox = {k: v for k, v in bbox.items() if k != 'i_class'}
-                bbox_voc = yolo_to_pascal_voc(bbox, image_width=label.image_width, image_height=label.image_height)
+                bbox_voc = yolo_to_pascal_voc(bbox._asdict(), image_width=label.image_width, image_height=label.image_height)
                 label.bboxes_voc.append(bbox_voc)
         return label
 
     def save(self, fname):
+        rows = [' '.join(map(str, bbox)) + '\n' for bbox in self.bboxes]
         with open(fname, 'w') as f:
-            for label in self.bboxes:
-                row = ' '.join([str(value) for value in label.values()])
-                row += '\n'
-                f.write(row)
+            f.write(''.join(rows))
 
     def to_tensor(self):
         return torch.tensor([[bbox['left'], bbox['top'], bbox['right'], bbox['bottom']] for bbox in self.bboxes_voc])
 
     def class_name_list(self, classes):
-        return [classes[bbox['i_class']] for bbox in self.bboxes]
+        return [classes[bbox.i_class] for bbox in self.bboxes]
 
 
 class MaskLabel(BaseLabel):
@@ -769,6 +888,12 @@ class MaskLabel(BaseLabel):
         voc = self.to_voc()
         utils.save_image(voc, fname)
 
+# Albumentations pipelines are built once and reused since the intensity does not change during a run
+_make_foreground_augmentation = functools.lru_cache(maxsize=1)(utils.make_foreground_augmentation)
+_make_background_augmentation = functools.lru_cache(maxsize=1)(utils.make_background_augmentation)
+_n_augmentation_workers = os.cpu_count() or 1
+_augmentation_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_n_augmentation_workers) # shared by foreground_augmentation()
+
 def foreground_augmentation(field_video: FieldVideo, intensity: float):
     """apply data augmentation to all the representative images of the given field video.
 
@@ -777,14 +902,19 @@ def foreground_augmentation(field_video: FieldVideo, intensity: float):
     An error will be raised if any of the rep-images is on a cuda device because 
     Albumentations cannot deal with images on GPUs.
     """
-    images = []
-    transform = utils.make_foreground_augmentation(p=intensity)
-    for rep_image in field_video.rep_images:
+    transform = _make_foreground_augmentation(p=intensity)
+
+    def augment(rep_image):
         transformed = transform(image=utils.tensorimage_to_numpy(rep_image.image))
         image = transformed['image']
-        image = utils.numpyimage_to_tensor(image)
-        images.append(image)
-    return images
+        return utils.numpyimage_to_tensor(image)
+
+    rep_images = field_video.rep_images
+    if len(rep_images) <= 1 or _n_augmentation_workers <= 1: # nothing to run in parallel
+        return [augment(rep_image) for rep_image in rep_images]
+    # OpenCV releases the GIL, so the rep-images can be augmented in parallel by threads.
+    # The executor starts a thread only when no idle one is left, so at most len(rep_images) threads work for this call.
+    return list(_augmentation_executor.map(augment, rep_images))
 
 def background_augmentation(frame: Union[np.ndarray, torch.Tensor], intensity: float, large_scale_jitter=False):
     """apply data augmentation to the given frame of a background video.
@@ -797,7 +927,7 @@ def background_augmentation(frame: Union[np.ndarray, torch.Tensor], intensity: f
         frame = utils.tensorimage_to_numpy(frame)
     if large_scale_jitter:
         frame = utils.random_scale_jitter(frame, mode='large')
-    transform = utils.make_background_augmentation(p=intensity)
+    transform = _make_background_augmentation(p=intensity)
     transformed = transform(image=frame)
     image = transformed['image']
     image = utils.numpyimage_to_tensor(image)
@@ -840,19 +970,22 @@ def make_composite_image(
         output_labeled_image_name = pathes.output_labeled_images_dir / output_image_name.name
         utils.save_labeled_image(frame, label, output_labeled_image_name, database.classes)
 
-def synthesize(*, frame, database, augment_intensity: float, prob: None, n_obj_mean: float, n_obj_std: float, scale_jitter=True): # , device='cpu'):
+def synthesize(*, frame, database, augment_intensity: float, prob: None, n_obj_mean: float, n_obj_std: float, scale_jitter=True, rng: np.random.Generator=None): # , device='cpu'):
     """randomly place foreground objects onto the given frame in-place
 
     frame: a frame taken from a background video
     field_video: a field video
     prob: the probablity that a foreground object will be picked from each class
+    rng: random number generator used to pick foreground objects (shared module-level one by default)
 
     Note
     ----
     - frame and all the rep-images of field_video are assume to be on cpu device at the call of this function.
     - device control is not implemented yet.
     """
-    n_obj = int(np.random.normal(loc=n_obj_mean, scale=n_obj_std)) # number of the objects scattered in the frame
+    if rng is None:
+        rng = _rng
+    n_obj = int(rng.normal(loc=n_obj_mean, scale=n_obj_std)) # number of the objects scattered in the frame
     n_class = database.n_class
     yololabel = YoloLabel(frame)
     masklabel = MaskLabel(frame)
@@ -860,47 +993,59 @@ def synthesize(*, frame, database, augment_intensity: float, prob: None, n_obj_m
     frame_aug = background_augmentation(frame, augment_intensity)
     
     with database.set_images_temporarily(rep_images_aug):
-        for obj in database.random_iter(total=n_obj, p=prob, min_n_obj=3):
+        for obj in database.random_iter(total=n_obj, p=prob, min_n_obj=3, rng=rng):
             bbox, mask_info = obj.random_place(frame_aug, return_bbox=True, return_mask=True, scale_jitter=scale_jitter)
             yololabel.add(i_class=obj.i_class, bbox=bbox)
             masklabel.add(mask_info)
 
     return frame_aug, yololabel, masklabel
 
-def make_rotated_rep_image(rep_image: RepImage, *, pathes: namedtuple, bbox: bool, suffix: str, pbar: tqdm, min_area:float=None):
+def make_rotated_rep_image(rep_image: RepImage, *, pathes: namedtuple, bbox: bool, suffix: str, pbar: tqdm, min_area:float=None, batch_size:int=None):
+    """batch_size: number of degrees whose rotation is computed at once.
+    Defaults to 8 on a CUDA device, where it saves kernel launches, and 1 otherwise, 
+    since the memory grows with batch_size while the CPU gains little from batching.
+    """
     n_class = len(rep_image.classes)
-    concat = torch.cat([rep_image.image, rep_image.classwise_mask])
+    # label the objects only once and rotate the label maps together with the image 
+    # instead of labeling connected components of the rotated masks for every degree
+    labels = torch.stack([label_connected_components(mask)[0] for mask in rep_image.classwise_mask])
+    concat = torch.cat([rep_image.image.to(labels.dtype), labels])
+    if batch_size is None:
+        batch_size = 8 if concat.is_cuda else 1
     
-    for degree in range(360):
-        image, label = _make_rotated_rep_image_impl(concat, degree=degree, n_class=n_class, min_area=min_area)
-        output_stem = f'{rep_image.p_image.stem}_{degree:03}degrees'
-        output_image_name = pathes.output_images_dir / (output_stem + utils.with_dot(suffix))
-        output_label_name = pathes.output_labels_dir / (output_stem + '.txt')
-        utils.save_image(image, output_image_name)
-        label.save(output_label_name)
-        if bbox:
-            output_labeled_image_name = pathes.output_labeled_images_dir / output_image_name.name
-            utils.save_labeled_image(image, label, output_labeled_image_name, rep_image.classes)
-        pbar.update(1)
+    for start in range(0, 360, batch_size):
+        degrees = range(start, min(start + batch_size, 360))
+        rotated = utils.rotate_batch(concat, degrees) # nearest interpolation keeps the labels as they are
+        for degree, rotated_concat in zip(degrees, rotated):
+            image, label = _make_rotated_rep_image_impl(rotated_concat, n_class=n_class, min_area=min_area)
+            output_stem = f'{rep_image.p_image.stem}_{degree:03}degrees'
+            output_image_name = pathes.output_images_dir / (output_stem + utils.with_dot(suffix))
+            output_label_name = pathes.output_labels_dir / (output_stem + '.txt')
+            utils.save_image(image, output_image_name)
+            label.save(output_label_name)
+            if bbox:
+                output_labeled_image_name = pathes.output_labeled_images_dir / output_image_name.name
+                utils.save_labeled_image(image, label, output_labeled_image_name, rep_image.classes)
+            pbar.update(1)
             
-def _make_rotated_rep_image_impl(concat, *, degree, n_class, min_area=None):
-    """image: Tensor (C, H, W)
-    classwise_mask: Tensor (n_class, H, W)
+def _make_rotated_rep_image_impl(rotated, *, n_class, min_area=None):
+    """rotated: Tensor (3 + n_class, H, W), i.e. a rotated image (3, H, W) stacked with 
+    the rotated label maps of the objects of each class (n_class, H, W)
     """
-    rotated = torchvision.transforms.functional.rotate(
-        concat, degree
-    )
-    image, classwise_mask = torch.split(rotated, [3, n_class], dim=0)
-    objectwise_mask = make_objectwise_mask(classwise_mask, n_class)
+    image, labels = torch.split(rotated, [3, n_class], dim=0)
+    image = image.to(torch.uint8)
+    labels = labels.cpu().numpy()
     label = YoloLabel(image, min_area=min_area)
         
     # bounding box info
     for i_class in range(n_class):
-        bboxes = get_bbox(objectwise_mask[i_class])
-        for bbox in bboxes:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                label.add(i_class=i_class, bbox=bbox)
+        bboxes = slices_to_bboxes([
+            s for s in ndi.find_objects(labels[i_class]) 
+            if s is not None # None if the object has been rotated out of the image
+        ])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            label.extend(i_class=i_class, bboxes=bboxes)
                 
     return image, label
 
@@ -0,0 +1,26 @@
+import torch
+import torchvision
+
+import _make_dataset
+
+
+def test_masks_to_bboxes_matches_torchvision():
+    masks = torch.zeros((2, 10, 12), dtype=torch.bool)
+    masks[0, 2:5, 3:9] = True
+    masks[1, 7, 0] = True
+    masks[1, 9, 11] = True
+    expected = torchvision.ops.masks_to_boxes(masks).to(int)
+    assert torch.equal(_make_dataset.masks_to_bboxes(masks), expected)
+
+
+def test_empty_mask_gives_zero_bbox():
+    masks = torch.zeros((2, 10, 12), dtype=torch.bool)
+    masks[1, 4:6, 5:7] = True
+    assert _make_dataset.masks_to_bboxes(masks)[0].tolist() == [0, 0, 0, 0]
+    assert _make_dataset.get_bbox(masks[0]) == dict(left=0, right=0, top=0, bottom=0)
+
+
+def test_empty_mask_is_not_labeled():
+    label = _make_dataset.YoloLabel(image_width=12, image_height=10)
+    label.add(i_class=0, bbox=_make_dataset.get_bbox(torch.zeros((10, 12), dtype=torch.bool)))
+    assert len(label.bboxes) == 0
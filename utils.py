@@ -5,9 +5,14 @@ import cv2
 import albumentations as A
 import matplotlib.pyplot as plt
 import pathlib
+import math
 import time
 import sys
 import os
+try: # optional: faster random access to video frames than OpenCV
+    import av
+except ImportError:
+    av = None
 
 # acceptable image/video suffixes: same as YOLOv5
 IMG_FORMATS = ['.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.dng', '.webp', '.mpo']
@@ -74,7 +79,8 @@ class FrameCannotBeLoaded(Exception):
     """
 
 def read_frame(cap, i_frame, device=None, as_numpy=False):
-    cap.set(cv2.CAP_PROP_POS_FRAMES, i_frame)
+    if cap.get(cv2.CAP_PROP_POS_FRAMES) != i_frame: # no need to seek when reading frames sequentially
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i_frame)
     opened, frame = cap.read()
     if not opened:
         raise FrameCannotBeLoaded
@@ -83,6 +89,70 @@ def read_frame(cap, i_frame, device=None, as_numpy=False):
     else:
         frame = numpyimage_to_tensor(frame, device=device, opencv=True)
     return frame
+
+AV_MAX_FORWARD_FRAMES = 32 # read_frame_av decodes forward instead of seeking if the frame is at most this far ahead
+
+class AVCapture:
+    """PyAV counterpart of cv2.VideoCapture: a container and the position of its decoder,
+    so that read_frame_av can decode forward from the last frame it read instead of seeking.
+    """
+    def __init__(self, container):
+        self.container = container
+        self.stream = container.streams.video[0]
+        self.decoder = None # iterator over the decoded frames
+        self.i_next_frame = None # index of the frame that the decoder yields next
+
+    def close(self):
+        self.container.close()
+
+def open_video_av(path):
+    """returns an AVCapture, or None if the frame rate or the duration of the video is unknown
+    (read_frame_av & count_frames_av cannot index frames then, so the caller should use OpenCV instead)
+    """
+    try:
+        container = av.open(str(path))
+    except av.error.FFmpegError:
+        raise Exception(f'Cannot open file {path}')
+    stream = container.streams.video[0]
+    known_length = stream.frames or stream.duration is not None or container.duration is not None
+    if stream.average_rate is None or stream.time_base is None or not known_length:
+        container.close()
+        return None
+    stream.thread_type = 'AUTO' # multi-threaded decoding
+    return AVCapture(container)
+
+def read_frame_av(cap, i_frame, device=None, as_numpy=False):
+    """same as read_frame, but reads from an AVCapture. Unless the i_frame-th frame is just ahead of
+    the last frame read, seek to the nearest keyframe before it first. Then decode forward until that frame.
+    """
+    stream = cap.stream
+    start = stream.start_time or 0
+    frame_duration = 1 / (stream.average_rate * stream.time_base) # in stream.time_base units
+    if cap.i_next_frame is None or not cap.i_next_frame <= i_frame <= cap.i_next_frame + AV_MAX_FORWARD_FRAMES:
+        cap.container.seek(start + int(i_frame * frame_duration), stream=stream)
+        cap.decoder = cap.container.decode(stream)
+    cap.i_next_frame = None # unknown until a frame is found
+    for frame in cap.decoder:
+        if frame.pts is None:
+            continue
+        i_decoded = round((frame.pts - start) / frame_duration)
+        if i_decoded >= i_frame:
+            break
+    else:
+        raise FrameCannotBeLoaded
+    cap.i_next_frame = i_decoded + 1
+    frame = frame.to_ndarray(format='rgb24')
+    if not as_numpy:
+        frame = numpyimage_to_tensor(frame, device=device)
+    return frame
+
+def count_frames_av(cap):
+    stream = cap.stream
+    if stream.frames:
+        return stream.frames
+    if stream.duration is not None:
+        return int(stream.duration * stream.time_base * stream.average_rate)
+    return int(cap.container.duration / av.time_base * stream.average_rate)
     
 def save_image(tensor, fname):
     tensor = tensor.cpu()
@@ -264,6 +334,67 @@ def make_background_augmentation(p=0.5):
     )
     return transform
 
+def _rotation_matrix(angle):
+    """inverse affine matrix (2 x 3) of the counter-clockwise rotation by angle degrees 
+    around the image center, the same as torchvision.transforms.functional.rotate
+    """
+    rot = math.radians(-angle)
+    return [[math.cos(rot), math.sin(rot), 0.0], [-math.sin(rot), math.cos(rot), 0.0]]
+
+def rotated_size(angle, *, width, height):
+    """(height, width) of an image rotated by angle degrees with expand=True, 
+    computed in the same way as torchvision.transforms.functional.rotate
+    """
+    halfw, halfh = 0.5 * width, 0.5 * height
+    pts = torch.tensor([[-halfw, -halfh, 1.0], [-halfw, halfh, 1.0], [halfw, halfh, 1.0], [halfw, -halfh, 1.0]])
+    new_pts = pts @ torch.tensor(_rotation_matrix(angle)).T
+    min_vals, max_vals = new_pts.min(dim=0).values, new_pts.max(dim=0).values # Tensor.aminmax needs PyTorch>=1.11
+    min_vals += torch.tensor((halfw, halfh))
+    max_vals += torch.tensor((halfw, halfh))
+    # truncate precision to 1e-4 to avoid ceil of Xe-15 to 1.0
+    tol = 1e-4
+    size = max_vals.div(tol).trunc_().mul_(tol).ceil_() - min_vals.div(tol).trunc_().mul_(tol).floor_()
+    return int(size[1]), int(size[0])
+
+def make_rotation_theta(angles, *, width, height, device=None):
+    """stack of the matrices of rotations by angles (in degrees) for affine_grid(), of shape (N, 3, 2)
+    width, height: size of the input image
+    """
+    theta = torch.tensor([_rotation_matrix(angle) for angle in angles], device=device)
+    return theta.transpose(1, 2) / torch.tensor([0.5 * width, 0.5 * height], device=device)
+
+def affine_grid(theta, *, out_width, out_height):
+    """sampling grid for torch.nn.functional.grid_sample (align_corners=False), of shape (N, out_height, out_width, 2)
+
+    Unlike torch.nn.functional.affine_grid, the output size may differ from the input size (i.e. expand=True) 
+    and the result is identical to that of torchvision.transforms.functional.rotate.
+    theta: output of make_rotation_theta()
+    """
+    # pixel centers relative to the image center, e.g. [-1.5, -0.5, 0.5, 1.5]
+    x = (2 * torch.arange(out_width, device=theta.device) - (out_width - 1)).to(theta.dtype) * 0.5
+    y = (2 * torch.arange(out_height, device=theta.device) - (out_height - 1)).to(theta.dtype) * 0.5
+    base_grid = torch.stack([
+        x.expand(out_height, out_width),
+        y.unsqueeze(-1).expand(out_height, out_width),
+        torch.ones_like(y).unsqueeze(-1).expand(out_height, out_width)
+    ], dim=-1)
+    n = theta.size(0)
+    grid = base_grid.view(1, out_height * out_width, 3).expand(n, -1, -1).bmm(theta)
+    return grid.view(n, out_height, out_width, 2)
+
+def rotate_batch(tensor, angles):
+    """rotate an image (C, H, W) by each of the angles (in degrees) at once, which gives a tensor of shape (N, C, H, W).
+    The same as torchvision.transforms.functional.rotate with nearest interpolation and expand=False.
+    """
+    height, width = tensor.size(-2), tensor.size(-1)
+    theta = make_rotation_theta(angles, width=width, height=height, device=tensor.device)
+    grid = affine_grid(theta, out_width=width, out_height=height)
+    batch = tensor.float().unsqueeze(0).expand(len(angles), -1, -1, -1) # view, no copy
+    rotated = torch.nn.functional.grid_sample(batch, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+    if not tensor.is_floating_point():
+        rotated = rotated.round()
+    return rotated.to(tensor.dtype)
+
 def random_scale_jitter(frame: np.ndarray):
     return torchvision.transforms.functional.random_affine(
         frame, degrees=0, translate=(0.2, 0.4), scale=(0.1, 2.0), fill=127